@@ -2,15 +2,49 @@
 """freestor.py is a script for uploading JSTOR articles to the Internet Archive.
 """
 import os
+import Queue
+import socket
+import sys
+import threading
+import multiprocessing
 
-from lxml import etree
+# Fall back to the stdlib's C ElementTree if lxml isn't installed; both
+# provide the iterparse() that parse_article_xml needs.
+try:
+    from lxml import etree
+    # Skip parser work that parse_article_xml never makes use of.
+    ITERPARSE_OPTIONS = dict(remove_blank_text=True, remove_comments=True,
+                             collect_ids=False, resolve_entities=False,
+                             huge_tree=False)
+except ImportError:
+    import xml.etree.cElementTree as etree
+    ITERPARSE_OPTIONS = {}
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.util import connection as urllib3_connection
 import jinja2
-import jsonpatch
-import json
+# Use ujson if it's available, otherwise the stdlib's json. Both are set up to
+# produce the same compact output.
+try:
+    import ujson
+    def json_dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    json_loads = ujson.loads
+except ImportError:
+    import json
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':'))
+    json_loads = json.loads
 # futures is a backport of concurrent.futures (released in python 3.2): 
 # https://code.google.com/p/pythonfutures/
 import futures
+# scandir is a backport of os.scandir (released in python 3.5):
+# https://github.com/benhoyt/scandir
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
 
 # My a.o functions: https://github.com/jjjake/ia-wrapper.git
 import archive
@@ -19,45 +53,229 @@ import archive
 XML_ROOT = '/2/data/jstor/bundle/articles/'
 PDF_ROOT = '/2/data/jstor/ejc/jstor-early-journal-content/'
 
+# Number of concurrent uploads, and how many articles may be queued up on the
+# executors ahead of them.
+MAX_UPLOADS = 32
+MAX_PARSERS = multiprocessing.cpu_count()
+MAX_QUEUED = MAX_UPLOADS * 2
+# Number of threads used to scan PDF_ROOT, and how many files they may find
+# ahead of pdf_iterator's consumer.
+SCAN_WORKERS = 8
+SCAN_QUEUED = 1024
+
+# (URN namespace, JSTOR XML field) pairs for the item's external-identifiers.
+EXTERNAL_ID_FIELDS = (
+    ('headid', 'headid'),
+    ('journalid', 'journalid'),
+    ('issueid', 'issueid'),
+    ('articleid', 'id'),
+)
+
+# archive.org hosts whose addresses are resolved once, by resolve_hosts(), and
+# then reused for every new connection.
+ARCHIVE_HOSTS = ('archive.org', 's3.us.archive.org')
+HOST_ADDRESSES = {}
+
+_create_connection = urllib3_connection.create_connection
+def create_connection(address, *args, **kwargs):
+    """urllib3's create_connection, connecting to the cached address for hosts
+    in HOST_ADDRESSES rather than resolving them again. If the cached address
+    can't be reached it's dropped, and the hostname is resolved as normal.
+    TLS still verifies and sends SNI for the hostname itself.
+    """
+    host, port = address
+    cached = HOST_ADDRESSES.get(host)
+    if cached is not None:
+        try:
+            return _create_connection((cached, port), *args, **kwargs)
+        except socket.error:
+            HOST_ADDRESSES.pop(host, None)
+    return _create_connection(address, *args, **kwargs)
+
+def resolve_hosts(hosts=ARCHIVE_HOSTS):
+    """Look up an IPv4 address for each of ``hosts``, cache it in
+    HOST_ADDRESSES, and have urllib3 connect to those addresses from now on.
+    This affects every urllib3 connection in the process, so it's only done by
+    __main__, not on import. Hosts that fail to resolve are left to urllib3's
+    normal resolution.
+    """
+    for host in hosts:
+        try:
+            info = socket.getaddrinfo(host, None, socket.AF_INET,
+                                      socket.SOCK_STREAM)
+        except socket.gaierror:
+            continue
+        HOST_ADDRESSES[host] = info[0][4][0]
+    urllib3_connection.create_connection = create_connection
+
+# One Session shared by all worker threads, so connections to archive.org are
+# pooled and kept alive rather than re-opened for every request.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=15, pool_maxsize=MAX_UPLOADS,
+                       max_retries=Retry(total=3, backoff_factor=0.3,
+                                         status_forcelist=[502, 503, 504]))
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
+if 'LOGGED_IN_SIG' in os.environ and 'LOGGED_IN_USER' in os.environ:
+    SESSION.cookies.update({'logged-in-sig': os.environ['LOGGED_IN_SIG'],
+                            'logged-in-user': os.environ['LOGGED_IN_USER']})
+
+# The item description template, compiled once rather than for every article.
+with open('description.html') as fh:
+    _DESC_TEMPLATE = jinja2.Environment(trim_blocks=True, lstrip_blocks=True,
+                                        autoescape=False).from_string(fh.read())
+
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-def pdf_iterator(directory):
-    """An iterator that yields file/article level metadata"""
-    for root, directories, files in os.walk(directory):
-        for f in files:
-            path = os.path.join(root, f)
-            path_details = path.split('/')[-4:]
-            md = dict(
-                    pdf_path = path,
-                    journal = path_details[0],
-                    issueid = path_details[1],
-                    articleid = '10.2307_{0}'.format(path_details[-1].split('.')[0]),
-            )
-            xml_path = os.path.join(XML_ROOT, ('{0}.xml'.format(md['articleid'])))
-            if os.path.exists(xml_path):
-                md['xml_path'] = xml_path
-            yield md
+def xml_index(directory=XML_ROOT):
+    """Return a set of the XML filenames in ``directory``, read with a single
+    directory scan.
+    """
+    return set(e.name for e in scandir(directory) if e.name.endswith('.xml'))
+
+def scan_files(directory, onerror=None):
+    """Recursively yield a DirEntry for every file under ``directory``.
+    Unlike os.walk, the file type comes from the directory listing itself, so
+    no extra stat is needed per entry.
+
+    As with os.walk, a directory that can't be listed is skipped; if
+    ``onerror`` is given it's called with the OSError.
+    """
+    try:
+        entries = list(scandir(directory))
+    except OSError as e:
+        if onerror is not None:
+            onerror(e)
+        return
+    for entry in entries:
+        if entry.is_dir():
+            # Like os.walk, don't descend into symlinked directories.
+            if not entry.is_symlink():
+                for f in scan_files(entry.path, onerror):
+                    yield f
+        else:
+            yield entry
+
+def scan_tree(directory, max_workers=SCAN_WORKERS, max_queued=SCAN_QUEUED,
+              onerror=None):
+    """Like scan_files, but each top-level directory (i.e. journal) is scanned
+    in its own thread, so that disk seeks overlap. Files are yielded as they
+    are found, and the threads stop scanning while ``max_queued`` of them are
+    waiting to be consumed. Unreadable directories are skipped and passed to
+    ``onerror``, as in scan_files.
+    """
+    found = Queue.Queue(maxsize=max_queued)
+    stopped = threading.Event()
+    done = object()
+
+    def scan(path):
+        try:
+            for f in scan_files(path, onerror):
+                if stopped.is_set():
+                    return
+                found.put(f)
+        except Exception:
+            # Anything other than an unreadable directory is a bug; hand it to
+            # the consumer with its traceback.
+            found.put(sys.exc_info())
+        finally:
+            found.put(done)
+
+    try:
+        entries = list(scandir(directory))
+    except OSError as e:
+        if onerror is not None:
+            onerror(e)
+        return
+    journals = []
+    for entry in entries:
+        if entry.is_dir():
+            if not entry.is_symlink():
+                journals.append(entry.path)
+        else:
+            yield entry
+
+    executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+    tasks = [executor.submit(scan, j) for j in journals]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            f = found.get()
+            if f is done:
+                remaining -= 1
+            elif isinstance(f, tuple):
+                raise f[0], f[1], f[2]
+            else:
+                yield f
+    finally:
+        # If we're stopping early, drain the queue so that no scan thread is
+        # left blocked on put().
+        stopped.set()
+        for task in tasks:
+            task.cancel()
+        while not all(task.done() for task in tasks):
+            try:
+                found.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        executor.shutdown()
+
+def pdf_iterator(directory, xml_names=None, onerror=None):
+    """An iterator that yields file/article level metadata. Directories that
+    can't be read are skipped, and passed to ``onerror`` if it's given.
+    """
+    if xml_names is None:
+        xml_names = xml_index()
+    for f in scan_tree(directory, onerror=onerror):
+        # Paths end in .../<journal>/<issueid>/<dir>/<file>.
+        rest, _, filename = f.path.rpartition('/')
+        rest = rest.rpartition('/')[0]
+        rest, _, issueid = rest.rpartition('/')
+        md = dict(
+                pdf_path = f.path,
+                journal = rest.rpartition('/')[2],
+                issueid = issueid,
+                articleid = '10.2307_{0}'.format(filename.partition('.')[0]),
+        )
+        xml_name = '{0}.xml'.format(md['articleid'])
+        if xml_name in xml_names:
+            md['xml_path'] = os.path.join(XML_ROOT, xml_name)
+        yield md
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 def parse_article_xml(xml_file):
-    """Parse a given JSTOR XML file into a Python dictionary."""
-    xml = etree.parse(open(xml_file)).getroot().getchildren()
-    xml_md = [e for e in xml if e.tag != 'pages']
+    """Parse a given JSTOR XML file into a Python dictionary.
+
+    The file is streamed with iterparse: each top-level element is read into
+    ``md`` as soon as it has been parsed, then removed from the tree so the
+    whole document never has to be held in memory at once.
+    """
     md = {}
-    for element in xml_md:
-        c_elements = element.getchildren()
-        if len(c_elements) == 0:
-            md[element.tag] = element.text.strip()
-            continue
-        md[element.tag] = []
-        for child in c_elements:
-            #if child is None:
-            #    continue
-            if child.text:
-                if child.text.strip() != '':
-                    md[element.tag].append(child.text.strip())
-            for x in child.getchildren():
-                md[element.tag].append({x.tag: x.text.strip()})
+    root = None
+    depth = 0
+    with open(xml_file, 'rb') as fh:
+        for event, element in etree.iterparse(fh, events=('start', 'end'),
+                                              **ITERPARSE_OPTIONS):
+            if event == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+            depth -= 1
+            # Only handle children of the root element.
+            if depth != 1:
+                continue
+            if element.tag != 'pages':
+                if len(element) == 0:
+                    md[element.tag] = element.text.strip()
+                else:
+                    values = md[element.tag] = []
+                    for child in element:
+                        text = child.text.strip() if child.text else ''
+                        if text != '':
+                            values.append(text)
+                        values.extend({x.tag: x.text.strip()} for x in child)
+            root.remove(element)
     return md
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -67,7 +285,7 @@ def make_ia_metadata(file_md, xml_md):
     """
     md = dict(
         # IA specific
-        identifier = 'jstor-{0}'.format(xml_md.get('id').split('/')[-1]),
+        identifier = 'jstor-{0}'.format(xml_md.get('id').rpartition('/')[2]),
         mediatype = 'texts',
         publisher = xml_md.get('journaltitle'),
         contributor = 'JSTOR',
@@ -105,17 +323,20 @@ def make_ia_metadata(file_md, xml_md):
     # Creator ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     authors = xml_md.get('authors')
     if authors:
-        auth_md = dict((k,v.encode('utf-8')) for d in authors for (k,v) in d.items())
+        auth_md = {}
+        for d in authors:
+            auth_md.update(d)
         if auth_md.get('givennames') is not None:
-            md['creator'] = '{0}, {1}'.format(auth_md['surname'].strip(' ,'),
-                                              auth_md['givennames'].strip(' ,'))
+            creator = u'{0}, {1}'.format(auth_md['surname'].strip(' ,'),
+                                         auth_md['givennames'].strip(' ,'))
                                               
         elif auth_md.get('stringname'):
-            md['creator'] = auth_md['stringname'].strip(' ,')
+            creator = auth_md['stringname'].strip(' ,')
         elif auth_md.get('surname'):
-            md['creator'] = auth_md['surname'].strip(' ,')
+            creator = auth_md['surname'].strip(' ,')
         else:
             raise NameError
+        md['creator'] = creator.encode('utf-8')
     else:
         md['creator'] = None
 
@@ -125,18 +346,8 @@ def make_ia_metadata(file_md, xml_md):
         md['language'] = languages[0].strip()
 
     # External-identifiers ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    external_ids = dict(
-            headid = xml_md.get('headid'),
-            journalid = xml_md.get('journalid'),
-            issueid = xml_md.get('issueid'),
-            articleid = xml_md.get('id'),
-    )
-
-    md['external-identifier'] = []
-    for k,v in external_ids.items():
-        if v:
-            id = 'urn:jstor-{0}:{1}'.format(k, v)
-            md['external-identifier'].append(id)
+    md['external-identifier'] = ['urn:jstor-{0}:{1}'.format(k, xml_md[x])
+                                 for k,x in EXTERNAL_ID_FIELDS if xml_md.get(x)]
 
     # Imagecount ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     if xml_md.get('pagerange'):
@@ -152,38 +363,53 @@ def make_ia_metadata(file_md, xml_md):
             md['imagecount'] = None # TODO: handle this exception better.
 
     # Generate Description ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    template = jinja2.Template(open('description.html').read())
     md['title'] = unicode(md['title']) # TODO: encode elsewhere...
-    md['description'] = template.render(metadata=md).replace('\n', '').strip()
+    md['description'] = _DESC_TEMPLATE.render(metadata=md).replace('\n', '').strip()
 
     # Finished ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    return dict((k,v) for k,v in md.items() if v)
+    return {k: v for k,v in md.iteritems() if v}
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def escape_pointer(key):
+    """Escape a key for use as a JSON Pointer reference token."""
+    return key.replace('~', '~0').replace('/', '~1')
+
 def modify_ia_metadata(identifier, metadata={}, target='metadata'):
     """ The IA Metadata API does not yet comply with the latest Json-Patch 
     standard. It currently complies with version 02: 
         https://tools.ietf.org/html/draft-ietf-appsawg-json-patch-02
-    The "patch = ..." line is a little hack, for the mean-time, to reformat the
-    patch returned by jsonpatch.py (wich complies with version 08).
+    Only top-level keys are ever changed, so the patch is built directly in
+    that format: one "add" or "replace" per key in ``metadata`` whose value
+    differs from what's already on the item.
+
+    Requires the LOGGED_IN_SIG and LOGGED_IN_USER environment variables, which
+    are loaded into SESSION's cookies at import time; raises KeyError if they
+    weren't set.
     """
-    log_in_cookies = {'logged-in-sig': os.environ['LOGGED_IN_SIG'],
-                      'logged-in-user': os.environ['LOGGED_IN_USER']}
+    for cookie in ('logged-in-sig', 'logged-in-user'):
+        if cookie not in SESSION.cookies:
+            raise KeyError('{0} cookie not set, export LOGGED_IN_SIG and '
+                           'LOGGED_IN_USER'.format(cookie))
     url = 'http://archive.org/metadata/{0}'.format(identifier)
-    src = requests.get(url).json().get(target, {})
-    dest = dict((src.items() + metadata.items()))
-    json_patch = jsonpatch.make_patch(src, dest).patch
-    patch = [{p['op']: p['path'], 'value': p['value']} for p in json_patch] 
+    src = json_loads(SESSION.get(url).content).get(target, {})
+    patch = [{'replace' if k in src else 'add': '/{0}'.format(escape_pointer(k)),
+              'value': v}
+             for k,v in metadata.iteritems() if k not in src or src[k] != v]
     if patch == []:
         return 'No changes made to metadata.'
-    params = {'-patch': json.dumps(patch), '-target': target}
-    r = requests.patch(url, params=params, cookies=log_in_cookies)
+    params = {'-patch': json_dumps(patch), '-target': target}
+    r = SESSION.patch(url, params=params)
     return r.content
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-def upload_article(article):
+def build_metadata(article):
+    """Parse an article's XML and build its IA metadata. This is the CPU-bound
+    half of an upload, run in a separate process by __main__.
+    """
     xml_md = parse_article_xml(article['xml_path'])
-    metadata = make_ia_metadata(article, xml_md)
+    return article, make_ia_metadata(article, xml_md)
+
+def upload_with_metadata(article, metadata):
     files = [article['pdf_path'], article['xml_path']]
     item = archive.Item(metadata['identifier'])
     upload_status = item.upload(files, metadata, 
@@ -191,6 +417,9 @@ def upload_article(article):
                                 ignore_bucket=False)
     return item.identifier, upload_status
 
+def upload_article(article):
+    return upload_with_metadata(*build_metadata(article))
+
 def upload_status(future):
     result = future.result()
     print 'Uploaded:\t{0}'.format(result[0])
@@ -200,27 +429,59 @@ if __name__ == '__main__':
     """Concurrently Upload all PDFs that have a matching JSTOR XML file to 
     archive.org
     """
-    with futures.ThreadPoolExecutor(max_workers=15) as executor:
-        for pdf in pdf_iterator(PDF_ROOT):
+    resolve_hosts()
+
+    # Bounds how far pdf_iterator runs ahead of the uploads, so the executors'
+    # queues don't grow to hold a future for every PDF in the collection.
+    queued = threading.BoundedSemaphore(MAX_QUEUED)
+
+    # XML parsing and metadata building run in cpu_pool, out of reach of the
+    # GIL; each finished article is then handed to io_pool to be uploaded.
+    def submit_upload(parsed):
+        # Free the article's slot if it fails to parse or can't be submitted,
+        # otherwise the main loop would eventually block on queued.acquire().
+        try:
+            future = io_pool.submit(upload_with_metadata, *parsed.result())
+        except Exception:
+            queued.release()
+            raise
+        future.add_done_callback(lambda f: queued.release())
+        future.add_done_callback(upload_status)
+
+    def unreadable(error):
+        print 'Unreadable:\t{0}'.format(error.filename)
+
+    # itemlist.txt is read once, for the Retry and METADATA MOD blocks below.
+    #with open('itemlist.txt') as fh:
+    #    ITEMLIST = frozenset(x.strip() for x in fh)
+
+    io_pool = futures.ThreadPoolExecutor(max_workers=MAX_UPLOADS)
+    cpu_pool = futures.ProcessPoolExecutor(max_workers=MAX_PARSERS)
+    # cpu_pool is shut down first, as its callbacks submit to io_pool.
+    with io_pool, cpu_pool:
+        # Fork cpu_pool's worker processes now, before pdf_iterator starts its
+        # scan threads.
+        cpu_pool.submit(int).result()
+        for pdf in pdf_iterator(PDF_ROOT, onerror=unreadable):
             try:
                 if not pdf.get('xml_path'):
                     print 'No XML file:\t{0}'.format(pdf.get('articleid'))
                     continue
 
                 # Retry >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
-                #do = [x.strip() for x in open('itemlist.txt')]
                 #pdf_id = pdf['articleid'].split('_')[-1]
-                #if not pdf_id in do:
+                #if pdf_id not in ITEMLIST:
                 #    continue
                 # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 
                 # Upload 
-                future = executor.submit(upload_article, article=pdf)
-                future.add_done_callback(upload_status)
+                queued.acquire()
+                parsed = cpu_pool.submit(build_metadata, pdf)
+                parsed.add_done_callback(submit_upload)
 
                 # METADATA MOD >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
                 #m = make_ia_metadata(pdf, parse_article_xml(pdf['xml_path']))
-                #if m['identifier'] in [x.strip() for x in open('itemlist.txt')]:
+                #if m['identifier'] in ITEMLIST:
                 #    print('\n--- {0} ---\n'.format(pdf['xml_path'])
                 #    print modify_ia_metadata(m['identifier'], m)
                 # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<